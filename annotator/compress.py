@@ -0,0 +1,138 @@
+"""Response compression for the annotation store.
+
+gzip is always available; brotli is used if the `brotli` package is
+installed.
+"""
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def gzip_compress(data, level=6):
+    # wbits of 16 + MAX_WBITS asks zlib for a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def brotli_compress(data, quality=5):
+    return brotli.compress(data, quality=quality)
+
+# Content codings in server preference order
+ENCODERS = OrderedDict()
+if brotli is not None:
+    ENCODERS['br'] = brotli_compress
+ENCODERS['gzip'] = gzip_compress
+
+def negotiate_encoding(accept_encoding, available=ENCODERS):
+    '''Pick the content coding to use for a response.
+
+    @param accept_encoding: value of the Accept-Encoding request header.
+    @param available: codings we can produce, in order of preference.
+    @return: the chosen coding, or None to send the body uncompressed.
+    '''
+    if not accept_encoding:
+        return None
+
+    prefs = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            k, _, v = param.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        prefs[coding] = q
+
+    best, best_q = None, 0.0
+    for coding in available:
+        q = prefs.get(coding, prefs.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+class CompressedBodyCache(object):
+    '''Bounded cache of compressed response bodies.
+
+    Entries are keyed on the coding and a digest of the uncompressed body, so
+    they never need invalidating: a changed body simply misses. Least
+    recently used entries are evicted once the compressed bytes held exceed
+    max_bytes.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.pop(key, None)
+            if body is not None:
+                self._entries[key] = body
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+class Compressor(object):
+    "Compresses response bodies, optionally caching the results."
+
+    def __init__(self, min_size=1024, cache_size=None):
+        '''
+        @param min_size: bodies smaller than this many bytes are sent as is.
+        @param cache_size: if set, keep up to this many bytes of compressed
+        bodies so that repeated reads of the same data are not recompressed.
+        '''
+        self.min_size = min_size
+        self.cache = CompressedBodyCache(cache_size) if cache_size else None
+
+    def compress(self, coding, body):
+        if self.cache is None:
+            return ENCODERS[coding](body)
+
+        key = (coding, hashlib.sha1(body).digest())
+        out = self.cache.get(key)
+        if out is None:
+            out = ENCODERS[coding](body)
+            self.cache.put(key, out)
+        return out
+
+    def __call__(self, request, response):
+        '''Compress the body of a webob response in place if the request
+        accepts a coding we support and the body is large enough.
+        '''
+        response.headers['Vary'] = 'Accept-Encoding'
+
+        if response.status_int != 200 or 'Content-Encoding' in response.headers:
+            return
+
+        body = response.body
+        if len(body) < self.min_size:
+            return
+
+        coding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+        if coding is None:
+            return
+
+        response.body = self.compress(coding, body)
+        response.headers['Content-Encoding'] = coding
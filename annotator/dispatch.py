@@ -0,0 +1,95 @@
+"""Lightweight request dispatch for the annotation store.
+
+The store only ever exposes a handful of fixed resource routes, so rather
+than asking routes.Mapper to walk its full match list on every request we
+can compile them once into a table keyed on (method, path shape).
+"""
+import urllib
+
+class Dispatcher(object):
+    "Direct (method, path shape) lookup for the annotation resource routes."
+
+    # (method, shape) -> action for the standard resource routes. A shape
+    # is 'collection', 'member' or the name of a custom collection action.
+    actions = {
+        ('GET',     'collection'): 'index',
+        ('POST',    'collection'): 'create',
+        ('OPTIONS', 'collection'): 'cors_preflight',
+        ('GET',     'member'):     'show',
+        ('PUT',     'member'):     'update',
+        ('DELETE',  'member'):     'delete',
+        ('OPTIONS', 'member'):     'cors_preflight',
+    }
+
+    def __init__(self, mount_point='/', resource_name=('annotation', 'annotations'),
+                 collection=None):
+        """
+        @param mount_point: url where the store is mounted.
+        @param resource_name: tuple (singular, plural) of the annotation resource name.
+        @param collection: dict of extra collection actions to their request
+        method, as passed to routes.Mapper.resource.
+        """
+        sing, plur = resource_name
+
+        self.controller = plur
+        self.collection = dict(collection or {})
+        self.actions = dict(self.actions)
+        for action, method in self.collection.items():
+            self.actions[(method, action)] = action
+
+        self.collection_path = mount_point.rstrip('/') + '/' + plur
+        self.member_prefix = self.collection_path + '/'
+
+    def match(self, method, path):
+        '''Match a request against the resource routes.
+
+        Returns a dict in the same form as routes.Mapper.match, or None if
+        nothing matches.
+        '''
+        fmt = None
+
+        if path == self.collection_path:
+            shape, id = 'collection', None
+        elif path.startswith(self.member_prefix):
+            rest = path[len(self.member_prefix):]
+            if not rest or '/' in rest:
+                return None
+            # Resource routes accept an optional, non-empty '.{format}'
+            # suffix, but the CORS preflight routes do not. Collection
+            # actions take everything after their name as the format, member
+            # routes only what follows the last '.'.
+            name, dot, suffix = rest.partition('.')
+            if self.collection.get(name) == method and (suffix or not dot):
+                shape, id = name, None
+                fmt = suffix or None
+            else:
+                shape, id = 'member', rest
+                head, dot, tail = rest.rpartition('.')
+                if head and tail and method != 'OPTIONS':
+                    id, fmt = head, tail
+        elif path.startswith(self.collection_path + '.') and method != 'OPTIONS':
+            shape, id = 'collection', None
+            fmt = path[len(self.collection_path) + 1:]
+            if not fmt:
+                return None
+        else:
+            return None
+
+        action = self.actions.get((method, shape))
+        if action is None:
+            return None
+
+        out = {'action': action}
+        if action != 'cors_preflight':
+            out['controller'] = self.controller
+        if id is not None:
+            out['id'] = id
+        if fmt is not None:
+            out['format'] = fmt
+        return out
+
+    def member_url(self, environ, id):
+        "Url of the annotation with the given id, as the routes URLGenerator would build it."
+        if isinstance(id, unicode):
+            id = id.encode('utf8')
+        return environ.get('SCRIPT_NAME', '') + self.member_prefix + urllib.quote(str(id))
@@ -0,0 +1,144 @@
+"""In-memory read model for frequently read documents.
+
+Rather than keeping ORM objects around, each annotation on a cached document
+is held as a small slotted record carrying its id and the JSON encoding of
+its as_dict(), ready to be spliced into responses.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class CachedAnnotation(object):
+    "Compact read-only form of an annotation."
+    __slots__ = ('id', 'json')
+
+    def __init__(self, id, json):
+        self.id = id
+        self.json = json
+
+    @classmethod
+    def from_annotation(cls, anno):
+        return cls(anno.id, json.dumps(anno.as_dict()))
+
+    def size(self):
+        "Approximate bytes held by this record."
+        return sys.getsizeof(self) + sys.getsizeof(self.id) + sys.getsizeof(self.json)
+
+class CachedDocument(object):
+    "All annotations on one document uri, in (created, id) order."
+    __slots__ = ('uri', 'annotations', 'size')
+
+    def __init__(self, uri, annotations):
+        self.uri = uri
+        self.annotations = tuple(annotations)
+        self.size = sys.getsizeof(self.annotations) + sum(a.size() for a in self.annotations)
+
+class HotDocumentCache(object):
+    '''Read-through cache of the annotations on recently read documents.
+
+    Documents are evicted least recently used first once the approximate
+    bytes held exceed max_bytes. Writers must call invalidate() for every uri
+    they touch once their change is committed.
+
+    Documents too big to cache are remembered (up to max_too_big of them,
+    least recently checked forgotten first, and until next invalidated) so
+    that they are not loaded again on every read.
+    '''
+    def __init__(self, max_bytes, max_too_big=1024):
+        self.max_bytes = max_bytes
+        self.max_too_big = max_too_big
+        self.size = 0
+        # Bumped on every invalidation, so that a document loaded from the
+        # database before a write is not stored after it.
+        self.generation = 0
+        self._documents = OrderedDict()
+        self._by_id = {}
+        self._too_big = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uri):
+        with self._lock:
+            doc = self._documents.pop(uri, None)
+            if doc is not None:
+                self._documents[uri] = doc
+            return doc
+
+    def find(self, id):
+        "Cached annotation with the given id, or None."
+        with self._lock:
+            return self._by_id.get(id)
+
+    def too_big(self, uri):
+        "True if the document at uri was found too big to cache."
+        with self._lock:
+            if self._too_big.pop(uri, None) is None:
+                return False
+            self._too_big[uri] = True
+            return True
+
+    def put(self, uri, annos, generation):
+        '''Cache the annotations on a document.
+
+        @param annos: iterable of Annotation objects, in (created, id) order.
+        It is not read any further once the document is found too big.
+        @param generation: value of self.generation read before the
+        annotations were loaded. If anything was invalidated since, the
+        annotations may be stale and are not cached.
+        @return: the CachedDocument built, or None if the document is too
+        big to cache.
+        '''
+        # The records alone are a lower bound on the document's size, so
+        # stop reading as soon as they pass max_bytes.
+        cached = []
+        size = 0
+        for anno in annos:
+            x = CachedAnnotation.from_annotation(anno)
+            cached.append(x)
+            size += x.size()
+            if size > self.max_bytes:
+                self._mark_too_big(uri)
+                return None
+
+        doc = CachedDocument(uri, cached)
+        if doc.size > self.max_bytes:
+            self._mark_too_big(uri)
+            return None
+
+        with self._lock:
+            if generation != self.generation:
+                return doc
+            self._remove(uri)
+            self._documents[uri] = doc
+            for x in doc.annotations:
+                self._by_id[x.id] = x
+            self.size += doc.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._documents)))
+        return doc
+
+    def invalidate(self, *uris):
+        with self._lock:
+            self.generation += 1
+            for uri in uris:
+                self._remove(uri)
+                # The document may have shrunk enough to cache
+                self._too_big.pop(uri, None)
+
+    def _mark_too_big(self, uri):
+        with self._lock:
+            self._too_big.pop(uri, None)
+            self._too_big[uri] = True
+            if len(self._too_big) > self.max_too_big:
+                self._too_big.popitem(last=False)
+
+    def _remove(self, uri):
+        doc = self._documents.pop(uri, None)
+        if doc is not None:
+            for x in doc.annotations:
+                self._by_id.pop(x.id, None)
+            self.size -= doc.size
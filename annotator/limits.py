@@ -0,0 +1,67 @@
+"""Admission control for the annotation store: per-client rate limits and a
+cap on concurrently running expensive requests.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+
+class RateLimiter(object):
+    '''Token bucket rate limit per client.
+
+    Each client may make up to `burst` requests at once, refilled at `rate`
+    requests per second. At most max_clients buckets are kept; beyond that
+    the least recently seen client is forgotten (and so starts again with a
+    full bucket).
+    '''
+    def __init__(self, rate, burst=None, max_clients=10000, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.max_clients = max_clients
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, client):
+        '''Take a token for a request from client.
+
+        @return: 0 if the request may go ahead, otherwise the number of
+        seconds until it would be allowed.
+        '''
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.pop(client, None)
+            if bucket is None:
+                bucket = TokenBucket(self.burst, now)
+                if len(self._buckets) >= self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                elapsed = max(0.0, now - bucket.stamp)
+                bucket.tokens = min(self.burst, bucket.tokens + elapsed * self.rate)
+                bucket.stamp = now
+            self._buckets[client] = bucket
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+            return (1 - bucket.tokens) / self.rate
+
+class ConcurrencyLimiter(object):
+    "Limit on the number of requests running at once."
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def acquire(self):
+        "Return True if a slot was free (and is now taken), without blocking."
+        return self._semaphore.acquire(False)
+
+    def release(self):
+        self._semaphore.release()
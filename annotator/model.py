@@ -4,62 +4,310 @@ If you are using this as a library you will want to use just the
 make_annotation_table method and the Annotation object.
 '''
 import os
+import re
 import uuid
+import zlib
 import logging
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger('annotator')
 
-from sqlalchemy import create_engine, MetaData, Table, Column
+from sqlalchemy import create_engine, MetaData, Table, Column, Index, DDL
 from sqlalchemy.types import Unicode, UnicodeText, DateTime, String
 from sqlalchemy.orm import sessionmaker, scoped_session, object_session
 from sqlalchemy.orm import mapper, class_mapper, clear_mappers, reconstructor
+from sqlalchemy.sql import expression, operators
+from sqlalchemy.ext.horizontal_shard import ShardedSession
 
 # Local
 from jsontype import JsonType
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 # Global session maker
 Session = scoped_session(sessionmaker(autoflush=True, autocommit=False))
 
+# The unsharded session maker, put back by configure() after configure_shards()
+_plain_session_factory = Session.session_factory
+
 # Global metadata instance
 metadata = None
 
+# Shard id -> engine when configured with configure_shards(), otherwise None
+shards = None
+
+# Thread pool used to query shards in parallel
+shard_pool = None
+
 # Model configuration
 def configure(dburi):
-    global metadata
+    global metadata, shards, shard_pool
 
     engine = create_engine(dburi, echo=False)
     metadata = MetaData(bind=engine)
+
+    if shard_pool is not None:
+        shard_pool.close()
+    set_session_factory(_plain_session_factory)
     Session.configure(bind=engine)
+    shards = None
+    shard_pool = None
+
+    annotation_table = make_annotation_table(metadata)
+
+    clear_mappers()
+    mapper(Annotation, annotation_table)
+
+def configure_shards(dburis):
+    '''Configure the model to spread annotations over several databases.
+
+    Each annotation is stored in the shard picked by hashing its uri (see
+    shard_for_uri). Queries filtering on a single uri go to that shard only;
+    other queries are issued against every shard.
+
+    @param dburis: list of database uris, one per shard. The order matters:
+    reordering the list moves documents between shards.
+    '''
+    global metadata, shards, shard_pool
+
+    if shard_pool is not None:
+        shard_pool.close()
 
-    # Annotation table
-    annotation_table = Table('annotation', metadata,
+    shards = {}
+    for i, dburi in enumerate(dburis):
+        shards[str(i)] = create_engine(dburi, echo=False)
+    metadata = MetaData()
+
+    set_session_factory(sessionmaker(
+        class_=ShardedSession,
+        autoflush=True,
+        autocommit=False,
+        shards=shards,
+        shard_chooser=_shard_chooser,
+        id_chooser=_id_chooser,
+        query_chooser=query_shards,
+    ))
+    shard_pool = ThreadPool(len(shards))
+
+    annotation_table = make_annotation_table(metadata)
+
+    clear_mappers()
+    mapper(Annotation, annotation_table)
+
+def set_session_factory(factory):
+    '''Make Session create its sessions with factory (a sessionmaker).
+
+    Sessions already open are removed first. Only needed to switch the session
+    class, as configure_shards() does; other settings can be changed with
+    Session.configure().
+    '''
+    Session.remove()
+    # ScopedSession has no public way to change its factory. This relies on
+    # the registry keeping it as `createfunc`, as in SQLAlchemy 0.6.
+    Session.session_factory = Session.registry.createfunc = factory
+
+def make_annotation_table(metadata, name='annotation'):
+    '''Define the annotation table on metadata and return it.'''
+    table = Table(name, metadata,
         Column('id', Unicode(36), primary_key=True, default=lambda:unicode(uuid.uuid4())),
         Column('uri', UnicodeText),
         Column('ranges', JsonType),
         Column('text', UnicodeText),
         Column('quote', UnicodeText),
-        Column('created', String(26), default=lambda:str(datetime.now())),
+        Column('created', DateTime, default=datetime.now),
+        Column('updated', DateTime, default=datetime.now, onupdate=datetime.now),
         Column('user', UnicodeText),
         Column('tags', JsonType),
         Column('extras', JsonType),
     )
 
-    clear_mappers()
-    mapper(Annotation, annotation_table)
+    # Results are returned in (created, id) order, optionally filtered by
+    # uri and time. Index names do not depend on the table name so that
+    # upgrade_engine can build the table under a temporary name.
+    Index('annotation_created_idx', table.c.created, table.c.id)
+    Index('annotation_updated_idx', table.c.updated)
+
+    # MySQL only indexes TEXT columns on a prefix of given length, which
+    # Index cannot express in SQLAlchemy 0.6, so this one is created by hand.
+    # 191 characters keeps the key within InnoDB's 767 bytes in utf8mb4.
+    uri_index = 'CREATE INDEX annotation_uri_created_idx ON %%(table)s (%s, created, id)'
+    DDL(uri_index % 'uri', on=_not_mysql).execute_at('after-create', table)
+    DDL(uri_index % 'uri(191)', on='mysql').execute_at('after-create', table)
+
+    return table
+
+def _not_mysql(ddl, event, target, bind, **kw):
+    return bind.engine.name != 'mysql'
 
 def createdb():
     logger.info('Creating db')
-    metadata.create_all()
+    if shards is None:
+        metadata.create_all()
+    else:
+        for engine in shards.values():
+            metadata.create_all(bind=engine)
 
 def cleandb():
-    metadata.drop_all()
+    if shards is None:
+        metadata.drop_all()
+    else:
+        for engine in shards.values():
+            metadata.drop_all(bind=engine)
     logger.info('Cleaned db')
 
 def rebuilddb():
     cleandb()
     createdb()
 
+def upgradedb():
+    '''Bring databases created by older versions up to the current schema.'''
+    if shards is None:
+        upgrade_engine(metadata.bind)
+    else:
+        for engine in shards.values():
+            upgrade_engine(engine)
+
+def upgrade_engine(engine, batch_size=1000):
+    '''Upgrade the annotation table in one database.
+
+    Versions up to 0.4 stored `created` as a string and had no `updated`
+    column. The table is rebuilt with typed, indexed timestamp columns, with
+    `updated` initialised to `created`. Values of `created` that cannot be
+    parsed are kept in `extras` and the column left NULL. Does nothing if the
+    table is already up to date.
+    '''
+    old = Table('annotation', MetaData(), autoload=True, autoload_with=engine)
+    if 'updated' in old.c:
+        return
+
+    logger.info('Upgrading annotation table on %s' % engine.url)
+
+    new = make_annotation_table(MetaData(), name='annotation_upgrade')
+    json_cols = [ c.key for c in new.c if isinstance(c.type, JsonType) ]
+
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        new.create(bind=conn)
+
+        result = conn.execute(old.select())
+        while True:
+            rows = [ dict(row) for row in result.fetchmany(batch_size) ]
+            if not rows:
+                break
+            for row in rows:
+                # Reflected columns are untyped, so JSON arrives still encoded
+                for k in json_cols:
+                    if row[k] is not None:
+                        row[k] = json.loads(row[k])
+                if row['created'] is not None:
+                    try:
+                        row['created'] = parse_datetime(row['created'])
+                    except ValueError:
+                        # 0.4 stored whatever clients sent. Keep it, but
+                        # where it will not be compared with real times.
+                        logger.warning('Annotation %s has unreadable created time %r, '
+                                       'moved to extras' % (row['id'], row['created']))
+                        row['extras'] = dict(row['extras'] or {}, created=row['created'])
+                        row['created'] = None
+                row['updated'] = row['created']
+            conn.execute(new.insert(), rows)
+
+        old.drop(bind=conn)
+        conn.execute('ALTER TABLE annotation_upgrade RENAME TO annotation')
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+_datetime_re = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?$'
+)
+
+def parse_datetime(value):
+    '''Parse a date or date and time as produced by str(datetime), or in
+    ISO 8601 format (without time zone).
+
+    @raise ValueError: if value is not in one of those formats.
+    '''
+    match = _datetime_re.match(value.strip())
+    if not match:
+        raise ValueError('Invalid date/time: %r' % value)
+    parts = list(match.groups())
+    if parts[6] is not None:
+        parts[6] = parts[6].ljust(6, '0')
+    return datetime(*[ int(x) for x in parts if x is not None ])
+
+def shard_ids():
+    return sorted(shards, key=int)
+
+def shard_for_uri(uri):
+    '''Id of the shard holding annotations on the document uri.'''
+    if uri is None:
+        uri = u''
+    if isinstance(uri, unicode):
+        uri = uri.encode('utf8')
+    return str((zlib.crc32(uri) & 0xffffffff) % len(shards))
+
+def map_shards(func, ids=None):
+    '''Call func(session, shard_id) for each shard in parallel.
+
+    Each call gets its own session, closed once func returns. Results are
+    returned in the same order as the shard ids.
+
+    @param ids: shard ids to visit, defaults to all of them.
+    '''
+    def run(shard_id):
+        session = Session.session_factory()
+        try:
+            return func(session, shard_id)
+        finally:
+            session.close()
+
+    if ids is None:
+        ids = shard_ids()
+    return shard_pool.map(run, ids)
+
+def _shard_chooser(mapper, instance, clause=None):
+    if instance is not None:
+        return shard_for_uri(instance.uri)
+    return shard_ids()[0]
+
+def _id_chooser(query, ident):
+    # Ids carry no shard information, so look everywhere
+    return shard_ids()
+
+def query_shards(query):
+    '''Ids of the shards a query needs to be run against.'''
+    uris = _uri_criteria(query._criterion)
+    if len(uris) == 1:
+        return [shard_for_uri(uris.pop())]
+    return shard_ids()
+
+def _uri_criteria(clause):
+    '''Set of uris which clause requires annotations to be equal to.
+
+    Only comparisons joined by AND at the top level of the clause are
+    considered.
+    '''
+    uris = set()
+    if isinstance(clause, expression.BooleanClauseList):
+        if clause.operator is operators.and_:
+            for c in clause.clauses:
+                uris.update(_uri_criteria(c))
+    elif isinstance(clause, expression._BinaryExpression):
+        if clause.operator is operators.eq \
+                and clause.left.shares_lineage(Annotation.uri.property.columns[0]) \
+                and isinstance(clause.right, expression._BindParamClause):
+            uris.add(clause.right.value)
+    return uris
+
 class Annotation(object):
     def __init__(self, **kwargs):
         self.reconstruct()
@@ -91,11 +339,18 @@ class Annotation(object):
 
         return out
 
+    # Timestamps are maintained by the store. Clients tend to send back the
+    # string values they were given, so only datetimes are accepted.
+    timestamps = ('created', 'updated')
+
     def merge_dict(self, anno_dict):
         attrnames = self.table.c.keys()
 
         for k, v in anno_dict.items():
-            if k in attrnames:
+            if k in self.timestamps:
+                if isinstance(v, datetime):
+                    setattr(self, k, v)
+            elif k in attrnames:
                 setattr(self, k, v)
             else:
                 self.extras[k] = v
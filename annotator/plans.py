@@ -0,0 +1,103 @@
+"""Compiled statement cache for annotation searches.
+
+Searches are mostly made with a few filter shapes (e.g. uri alone, or uri
+and user), so rather than building and compiling an ORM query on every
+request the SQL for each shape is compiled once and reused, with the filter
+values and the page wanted bound as parameters.
+"""
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import select, and_, func, bindparam
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.ext.compiler import compiles
+
+# Value to bind as LIMIT for "all rows", for each dialect where LIMIT and
+# OFFSET can be bound as parameters. Other dialects (which page with TOP or
+# ROWNUM) get a statement compiled for each page instead.
+unlimited = {
+    'sqlite': -1,
+    'postgresql': None,
+    'mysql': 18446744073709551615,
+}
+
+class Paged(Executable, ClauseElement):
+    "A select with LIMIT and OFFSET bound to page_limit and page_offset."
+
+    def __init__(self, select):
+        self.select = select
+
+@compiles(Paged)
+def _compile_paged(element, compiler, **kw):
+    return '%s \n LIMIT %s OFFSET %s' % (
+        compiler.process(element.select, **kw),
+        compiler.process(bindparam('page_limit')),
+        compiler.process(bindparam('page_offset')),
+    )
+
+class SearchPlan(object):
+    '''Statements for one search shape.
+
+    @param table: the annotation table.
+    @param fields: names of columns filtered on equality.
+    @param conditions: list of (name, column name, operator) for other
+    comparisons, each bound to the parameter `name`.
+    '''
+    def __init__(self, table, fields, conditions):
+        clauses = [ table.c[k] == bindparam(k) for k in fields ]
+        clauses += [ op(table.c[col], bindparam(name)) for name, col, op in conditions ]
+        where = and_(*clauses) if clauses else None
+
+        self.count = select([func.count()], where, from_obj=[table])
+        self.page = select([table], where, order_by=[table.c.created, table.c.id])
+        self._compiled = {}
+
+    def compiled(self, dialect, offset=0, limit=None):
+        '''Statements for a page of results, compiled for dialect.
+
+        @return: tuple (count, page, page_params); page_params are the
+        parameters to execute page with in addition to the filter values.
+        '''
+        try:
+            count, page = self._compiled[dialect]
+        except KeyError:
+            count = self.count.compile(dialect=dialect)
+            page = None
+            if dialect.name in unlimited:
+                page = Paged(self.page).compile(dialect=dialect)
+            self._compiled[dialect] = (count, page)
+
+        if page is None:
+            page = self.page.offset(offset or None).limit(limit)
+            return count, page.compile(dialect=dialect), {}
+
+        if limit is None:
+            limit = unlimited[dialect.name]
+        return count, page, {'page_limit': limit, 'page_offset': offset}
+
+class SearchPlanCache(object):
+    "Least recently used cache of SearchPlans."
+
+    def __init__(self, max_plans=256):
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, table, fields, conditions):
+        '''Return the plan for a search shape, building it if needed.
+
+        @param fields: iterable of column names filtered on equality.
+        @param conditions: iterable of (name, column name, operator).
+        '''
+        fields = tuple(sorted(fields))
+        conditions = tuple(sorted(conditions))
+        key = (table, fields, conditions)
+
+        with self._lock:
+            plan = self._plans.pop(key, None)
+            if plan is None:
+                plan = SearchPlan(table, fields, conditions)
+                if len(self._plans) >= self.max_plans:
+                    self._plans.popitem(last=False)
+            self._plans[key] = plan
+            return plan
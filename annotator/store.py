@@ -1,31 +1,94 @@
 """Annotation storage.
 """
 import os
+import copy
+import math
+import heapq
 import logging
+import operator
+import itertools
 try:
     import json
 except ImportError:
     import simplejson as json
 
 import paste.request
+from paste.util.converters import asbool
 import routes
 import webob
 
 import annotator.model as model
 from annotator.model import Annotation, Session
+from annotator.dispatch import Dispatcher
+from annotator.compress import Compressor
+from annotator.hotcache import HotDocumentCache
+from annotator.limits import RateLimiter, ConcurrencyLimiter
+from annotator.plans import SearchPlanCache
 
 logger = logging.getLogger('annotator')
 
 class AnnotatorStore(object):
     "Application to provide 'annotation' store."
 
-    def __init__(self, mount_point='/', resource_name=('annotation', 'annotations')):
+    # Custom collection actions and their request methods
+    collection = {
+        'search': 'GET',
+        'fetch':  'POST',
+    }
+
+    # Maximum number of ids in each IN clause of a multi-get
+    fetch_chunk_size = 500
+
+    # Actions limited by max_concurrent
+    expensive_actions = ('index', 'search', 'fetch', 'create')
+
+    # Annotation attributes which can be searched on
+    search_fields = ('id', 'uri', 'text', 'quote', 'user')
+
+    # Search parameters filtering on time, with the column and comparison
+    # each applies
+    time_filters = {
+        'created_after':  ('created', operator.gt),
+        'created_before': ('created', operator.lt),
+        'updated_since':  ('updated', operator.ge),
+    }
+
+    # Other parameters search accepts ('_' is added by jQuery to defeat caching)
+    search_controls = ('all_fields', 'offset', 'limit', 'callback', 'format', '_')
+
+    def __init__(self, mount_point='/', resource_name=('annotation', 'annotations'),
+                 fast_dispatch=False, compress_min_size=None, compress_cache_size=None,
+                 hot_cache_size=None, rate_limit=None, rate_burst=None,
+                 rate_limit_key='ip', max_clients=10000, max_results=None,
+                 max_concurrent=None):
         """Create the WSGI application.
 
         @param mount_point: url where this application is mounted.
         @param resource_name: tuple (singular, plural) of the annotation resource name.
+        @param fast_dispatch: match requests with a precompiled dispatch table
+        instead of routes.Mapper.
+        @param compress_min_size: gzip/brotli encode response bodies of at
+        least this many bytes when the client accepts it. None (the default)
+        disables compression.
+        @param compress_cache_size: bytes of compressed bodies to keep so
+        repeated reads are not compressed again. None disables the cache.
+        @param hot_cache_size: bytes of memory to use for caching the
+        annotations on frequently read documents. None disables the cache.
+        Only writes made through this application invalidate the cache.
+        @param rate_limit: requests per second allowed for each client. None
+        disables rate limiting.
+        @param rate_burst: requests a client may make at once before being
+        limited. Defaults to rate_limit (or 1 if that is lower).
+        @param rate_limit_key: identify clients by 'ip' (REMOTE_ADDR) or by
+        'user' (REMOTE_USER, falling back to the ip).
+        @param max_clients: number of clients to track rate limits for.
+        @param max_results: cap on the number of annotations returned by any
+        one request. None for no cap.
+        @param max_concurrent: number of index, search, fetch and create
+        requests allowed to run at once. None for no limit.
         """
         self.mapper = routes.Mapper()
+        self.resource_name = resource_name
 
         mount_point = mount_point if mount_point.startswith('/') else '/' + mount_point
         sing, plur  = resource_name
@@ -34,26 +97,63 @@ class AnnotatorStore(object):
             sing,
             plur,
             path_prefix = mount_point,
-            collection = {
-                'search': 'GET'
-            }
+            collection = self.collection
         )
 
         with self.mapper.submapper(
             action='cors_preflight',
-            path_prefix=mount_point,
+            path_prefix=mount_point.rstrip('/') + '/',
             conditions=dict(method=["OPTIONS"])
         ) as m:
             m.connect(None, plur)
             m.connect(None, plur + '/{id}')
 
+        if fast_dispatch:
+            self.dispatcher = Dispatcher(mount_point, resource_name, self.collection)
+        else:
+            self.dispatcher = None
+
+        if compress_min_size is not None:
+            self.compressor = Compressor(compress_min_size, compress_cache_size)
+        else:
+            self.compressor = None
+
+        if hot_cache_size:
+            self.hot_cache = HotDocumentCache(hot_cache_size)
+        else:
+            self.hot_cache = None
+
+        if rate_limit:
+            self.rate_limiter = RateLimiter(rate_limit, rate_burst, max_clients)
+        else:
+            self.rate_limiter = None
+        self.rate_limit_key = rate_limit_key
+
+        if max_concurrent:
+            self.concurrency_limiter = ConcurrencyLimiter(max_concurrent)
+        else:
+            self.concurrency_limiter = None
+
+        self.max_results = max_results
+
+        self.plans = SearchPlanCache()
+
     def __call__(self, environ, start_response):
+        # Each request is handled on a shallow copy of the store, so the
+        # request state set below is not shared between threads while the
+        # mapper, caches and limiters are.
+        return copy.copy(self)._handle(environ, start_response)
+
+    def _handle(self, environ, start_response):
         self.session = model.Session()
-        self.mapper.environ = environ
-        self.url = routes.util.URLGenerator(self.mapper, environ)
+        self.environ = environ
+        self._url = None
 
         path = environ['PATH_INFO']
-        self.mapdict = self.mapper.match(path)
+        if self.dispatcher is not None:
+            self.mapdict = self.dispatcher.match(environ['REQUEST_METHOD'], path)
+        else:
+            self.mapdict = self.mapper.match(path, environ)
         self.request = webob.Request(environ)
         self.response = webob.Response(charset='utf8')
         self.format = self.request.params.get('format', 'json')
@@ -73,8 +173,14 @@ class AnnotatorStore(object):
 
         if self.mapdict is not None:
             action = self.mapdict['action']
-            method = getattr(self, action)
-            out = method()
+            wait = self._admit(action)
+            if wait:
+                out = self._429(wait)
+            else:
+                try:
+                    out = getattr(self, action)()
+                finally:
+                    self._release(action)
             if out is not None:
                 self.response.unicode_body = out
             if self.response.status_int == 204:
@@ -82,9 +188,61 @@ class AnnotatorStore(object):
         else:
             self.response.unicode_body = self._404()
 
+        if self.compressor is not None:
+            self.compressor(self.request, self.response)
+
         self.session.close()
         return self.response(environ, start_response)
 
+    @property
+    def url(self):
+        "URL generator for the current request, built on first use."
+        if self._url is None:
+            self._url = routes.util.URLGenerator(self.mapper, self.environ)
+        return self._url
+
+    def _location(self, id):
+        if self.dispatcher is not None:
+            return self.dispatcher.member_url(self.environ, id)
+        return self.url(self.resource_name[0], id=id)
+
+    def _client(self):
+        if self.rate_limit_key == 'user' and self.environ.get('REMOTE_USER'):
+            return 'user:' + self.environ['REMOTE_USER']
+        return 'ip:' + self.environ.get('REMOTE_ADDR', '')
+
+    def _admit(self, action):
+        '''Decide whether to run an action for the current request.
+
+        @return: 0 to go ahead, otherwise seconds the client should wait.
+        '''
+        if action == 'cors_preflight':
+            return 0
+
+        # Take the concurrency slot first so that a request turned away for
+        # it does not also use up one of the client's rate limit tokens.
+        expensive = self.concurrency_limiter is not None and action in self.expensive_actions
+        if expensive and not self.concurrency_limiter.acquire():
+            return 1
+
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.acquire(self._client())
+            if wait:
+                if expensive:
+                    self.concurrency_limiter.release()
+                return wait
+        return 0
+
+    def _release(self, action):
+        if self.concurrency_limiter is not None and action in self.expensive_actions:
+            self.concurrency_limiter.release()
+
+    def _capped(self, limit):
+        "Apply max_results to a requested number of results (None for all)."
+        if self.max_results is not None and (limit is None or limit > self.max_results):
+            return self.max_results
+        return limit
+
     def _204(self):
         self.response.status = 204
         return None
@@ -93,6 +251,11 @@ class AnnotatorStore(object):
         self.response.status = 400
         return u'Bad Request'
 
+    def _429(self, retry_after):
+        self.response.status = '429 Too Many Requests'
+        self.response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return u'Too Many Requests'
+
     def _404(self):
         self.response.status = 404
         return u'Not Found'
@@ -102,7 +265,9 @@ class AnnotatorStore(object):
         return u'Internal Server Error'
 
     def _json(self, result):
-        result_json = json.dumps(result)
+        return self._json_raw(json.dumps(result))
+
+    def _json_raw(self, result_json):
         if 'callback' in self.request.params:
             self.response.content_type = 'text/javascript'
             return u'%s(%s);' % (self.request.params['callback'], result_json)
@@ -111,13 +276,63 @@ class AnnotatorStore(object):
             return u'%s' % result_json
 
     def index(self):
+        if 'ids' in self.request.params:
+            ids = self.request.params['ids'].split(',')
+            return self._fetch(ids)
+
+        total, annos = self._page({}, {}, 0, self._capped(100), count=False)
         result = []
-        for anno in self.session.query(Annotation).limit(100).all():
+        for anno in annos:
             result.append(anno.as_dict())
         return self._json(result)
 
+    def fetch(self):
+        if 'json' in self.request.params:
+            params = json.loads(self.request.params['json'])
+        else:
+            params = dict(self.request.params)
+
+        if isinstance(params, dict):
+            ids = params.get('ids')
+        else:
+            ids = params
+
+        if isinstance(ids, basestring):
+            ids = ids.split(',')
+
+        if not isinstance(ids, list):
+            return self._400()
+
+        return self._fetch(ids)
+
+    def _fetch(self, ids):
+        """Look up many annotations by id with as few queries as possible.
+
+        Responds with the annotations in the order their ids were given. Ids
+        that were not found are returned as {'id': id, 'missing': True}.
+        """
+        ids = [ unicode(x) for x in ids if x ]
+        if len(ids) != self._capped(len(ids)):
+            return self._400()
+        wanted = list(set(ids))
+
+        found = {}
+        for i in xrange(0, len(wanted), self.fetch_chunk_size):
+            chunk = wanted[i:i + self.fetch_chunk_size]
+            q = self.session.query(Annotation).filter(Annotation.id.in_(chunk))
+            for anno in q:
+                found[anno.id] = anno.as_dict()
+
+        return self._json([ found.get(x) or {'id': x, 'missing': True} for x in ids ])
+
     def show(self):
         id = self.mapdict['id']
+
+        if self.hot_cache is not None:
+            cached = self.hot_cache.find(id)
+            if cached is not None:
+                return self._json_raw(cached.json)
+
         anno = self.session.query(Annotation).get(id)
 
         if not anno:
@@ -140,9 +355,10 @@ class AnnotatorStore(object):
 
         self.session.add(anno)
         self.session.commit()
+        self._invalidate(anno.uri)
 
         self.response.status = 303
-        self.response.headers['Location'] = self.url('annotation', id=anno.id)
+        self.response.headers['Location'] = self._location(anno.id)
 
         return None
 
@@ -160,12 +376,62 @@ class AnnotatorStore(object):
             params = dict(self.request.params)
 
         params['id'] = id
+        old_uri = anno.uri
+
+        if model.shards is not None and 'uri' in params \
+                and model.shard_for_uri(params['uri']) != model.shard_for_uri(anno.uri):
+            return self._move(anno, params)
+
         anno.merge_dict(params)
 
         self.session.commit()
+        self._invalidate(old_uri, anno.uri)
 
         return self._json(anno.as_dict())
 
+    def _move(self, anno, params):
+        '''Update an annotation whose new uri belongs in another shard.
+
+        The updated copy is committed to its new shard before the original is
+        deleted, so if that fails the annotation is left where it was. If
+        the delete fails instead, the annotation is left in both shards and
+        the error logged.
+        '''
+        id, old_uri = anno.id, anno.uri
+        copy = Annotation.from_dict(anno.as_dict())
+        copy.created = anno.created
+        copy.merge_dict(params)
+
+        # The copy has the same id as anno, so it cannot share its session.
+        # Until anno is deleted a lookup by id would find both, so the copy
+        # must not be reloaded after commit.
+        session = model.Session.session_factory(expire_on_commit=False)
+        try:
+            session.add(copy)
+            session.commit()
+            result = copy.as_dict()
+        except:
+            session.rollback()
+            logger.exception('Moving annotation %s to a new shard failed' % id)
+            return self._500()
+        finally:
+            session.close()
+
+        try:
+            self.session.delete(anno)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            logger.exception('Annotation %s was copied to shard %s but could not be '
+                             'deleted from shard %s; it is now stored in both' %
+                             (id, model.shard_for_uri(result['uri']),
+                              model.shard_for_uri(old_uri)))
+            return self._500()
+        finally:
+            self._invalidate(old_uri, result['uri'])
+
+        return self._json(result)
+
     def delete(self):
         id = self.mapdict['id']
 
@@ -177,33 +443,45 @@ class AnnotatorStore(object):
         try:
             self.session.delete(anno)
             self.session.commit()
+            self._invalidate(anno.uri)
 
             return self._204()
         except:
             return self._500()
 
     def search(self):
-        params = [
-            (k,v) for k,v in self.request.params.items() if k not in [ 'all_fields', 'offset', 'limit' ]
-        ]
+        fields = {}
+        times = {}
+        for k,v in self.request.params.items():
+            if k in self.search_fields:
+                fields[k] = unicode(v)
+            elif k in self.time_filters:
+                try:
+                    times[k] = model.parse_datetime(v)
+                except ValueError:
+                    return self._400()
+            elif k not in self.search_controls:
+                return self._400()
 
         all_fields = self.request.params.get('all_fields', False)
         all_fields = bool(all_fields)
 
-        offset = self.request.params.get('offset', 0)
-        limit = int(self.request.params.get('limit', 100))
+        try:
+            offset = max(0, int(self.request.params.get('offset', 0)))
+            limit = int(self.request.params.get('limit', 100))
+        except ValueError:
+            return self._400()
 
         if limit < 0:
             limit = None
+        limit = self._capped(limit)
 
-        q = self.session.query(Annotation)
-
-        for k,v in params:
-            kwargs = { k: unicode(v) }
-            q = q.filter_by(**kwargs)
+        if self.hot_cache is not None and not times and fields.keys() == ['uri']:
+            out = self._search_hot(fields['uri'], offset, limit, all_fields)
+            if out is not None:
+                return out
 
-        total = q.count()
-        results = q.offset(offset).limit(limit).all()
+        total, results = self._page(fields, times, offset, limit)
 
         if all_fields:
             results = [ x.as_dict() for x in results ]
@@ -217,6 +495,121 @@ class AnnotatorStore(object):
 
         return self._json(qresults)
 
+    def _search_hot(self, uri, offset, limit, all_fields):
+        '''Search on a single document uri, served from the hot cache.
+
+        @return: the response body, or None if the document is too big to
+        cache.
+        '''
+        doc = self.hot_cache.get(uri)
+        if doc is None:
+            if self.hot_cache.too_big(uri):
+                return None
+            doc = self._load_hot(uri)
+            if doc is None:
+                return None
+
+        end = None if limit is None else offset + limit
+        page = doc.annotations[offset:end]
+
+        if all_fields:
+            results = u'[%s]' % u', '.join(x.json for x in page)
+        else:
+            results = json.dumps([ {'id': x.id} for x in page ])
+
+        return self._json_raw(u'{"total": %d, "results": %s}' % (len(doc.annotations), results))
+
+    def _load_hot(self, uri):
+        '''Load the annotations on a document into the hot cache.
+
+        Rows are read a few at a time, and no more are read once the document
+        is known to be too big to cache.
+
+        @return: the CachedDocument, or None if it is too big.
+        '''
+        generation = self.hot_cache.generation
+        table = model.metadata.tables['annotation']
+        plan = self.plans.get(table, ['uri'], [])
+        shard_id = model.shard_for_uri(uri) if model.shards is not None else None
+
+        total, annos = self._execute(self.session, plan, {'uri': uri}, False,
+                                     shard_id=shard_id, yield_per=100)
+        try:
+            return self.hot_cache.put(uri, annos, generation)
+        finally:
+            annos.close()
+
+    def _invalidate(self, *uris):
+        if self.hot_cache is not None:
+            self.hot_cache.invalidate(*uris)
+
+    def _page(self, fields, times, offset=0, limit=None, count=True):
+        '''Fetch one page of annotations, ordered by creation time.
+
+        With a sharded model, a search that is not confined to one uri is
+        run against every shard in parallel and the pages merged.
+
+        @param fields: dict of attribute values annotations must have.
+        @param times: dict of time_filters to the datetime each compares with.
+        @param count: if False, do not count the total number of results.
+        @return: tuple (total, annotations); total is None if not counted.
+        '''
+        table = model.metadata.tables['annotation']
+        conditions = [ (k,) + self.time_filters[k] for k in times ]
+        params = dict(fields)
+        params.update(times)
+
+        plan = self.plans.get(table, fields, conditions)
+
+        if model.shards is None:
+            return self._execute(self.session, plan, params, count, offset, limit)
+
+        if 'uri' in fields:
+            shard_id = model.shard_for_uri(fields['uri'])
+            return self._execute(self.session, plan, params, count, offset, limit, shard_id)
+
+        end = None if limit is None else offset + limit
+
+        def run(session, shard_id):
+            return self._execute(session, plan, params, count, 0, end, shard_id)
+
+        pages = model.map_shards(run)
+
+        total = sum(t for t, annos in pages) if count else None
+        merged = heapq.merge(*[
+            [ ((x.created, x.id), x) for x in annos ] for t, annos in pages
+        ])
+        return total, [ x for key, x in itertools.islice(merged, offset, end) ]
+
+    def _execute(self, session, plan, params, count, offset=0, limit=None,
+                 shard_id=None, yield_per=None):
+        '''Run a SearchPlan in session, returning (total, annotations).
+
+        @param offset, limit: page of results to return (limit None for all).
+        @param yield_per: if given, annotations are returned as an iterator
+        loading this many rows at a time rather than as a list.
+        '''
+        if shard_id is None:
+            conn = session.connection()
+        else:
+            conn = session.connection(shard_id=shard_id)
+
+        count_sql, page_sql, page_params = plan.compiled(conn.dialect, offset, limit)
+        total = conn.execute(count_sql, params).scalar() if count else None
+        page_params.update(params)
+        result = conn.execute(page_sql, page_params)
+        if yield_per is not None:
+            return total, self._stream(session, result, yield_per)
+        return total, list(session.query(Annotation).instances(result))
+
+    def _stream(self, session, result, yield_per):
+        "Iterate over the annotations in result, closing it once done with."
+        try:
+            for anno in session.query(Annotation).yield_per(yield_per).instances(result):
+                yield anno
+        finally:
+            result.close()
+
     def cors_preflight(self):
         # CORS headers already added in __call__
         return self._204()
@@ -226,9 +619,36 @@ def make_app(global_config, **local_conf):
 
     Designed for use by paster or modwsgi etc
     '''
-    model.configure(local_conf['dburi'])
+    if local_conf.get('shard_dburis'):
+        model.configure_shards(local_conf['shard_dburis'].split())
+    else:
+        model.configure(local_conf['dburi'])
     model.createdb()
+    model.upgradedb()
+
+    def optional(key, type_):
+        value = local_conf.get(key)
+        if value:
+            return type_(value)
+        return None
 
-    app = AnnotatorStore(mount_point=local_conf.get('mount_point') or '/')
+    if asbool(local_conf.get('compress', False)):
+        compress_min_size = int(local_conf.get('compress_min_size', 1024))
+    else:
+        compress_min_size = None
+
+    app = AnnotatorStore(
+        mount_point=local_conf.get('mount_point') or '/',
+        fast_dispatch=asbool(local_conf.get('fast_dispatch', False)),
+        compress_min_size=compress_min_size,
+        compress_cache_size=optional('compress_cache_size', int),
+        hot_cache_size=optional('hot_cache_size', int),
+        rate_limit=optional('rate_limit', float),
+        rate_burst=optional('rate_burst', float),
+        rate_limit_key=local_conf.get('rate_limit_key', 'ip'),
+        max_clients=optional('max_clients', int) or 10000,
+        max_results=optional('max_results', int),
+        max_concurrent=optional('max_concurrent', int)
+    )
     return app
 
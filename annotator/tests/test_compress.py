@@ -0,0 +1,101 @@
+import gzip
+import json
+from StringIO import StringIO
+
+import paste.fixture
+
+import annotator.model as model
+from annotator.model import Annotation
+from annotator.compress import negotiate_encoding, CompressedBodyCache, Compressor
+import annotator.store as store
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+class TestNegotiateEncoding(object):
+
+    def test_no_header(self):
+        assert negotiate_encoding(None) is None
+        assert negotiate_encoding('') is None
+
+    def test_gzip(self):
+        assert negotiate_encoding('gzip, deflate', ['gzip']) == 'gzip'
+
+    def test_unsupported(self):
+        assert negotiate_encoding('deflate, identity', ['br', 'gzip']) is None
+
+    def test_qvalues(self):
+        assert negotiate_encoding('gzip;q=0.5, br;q=0.8', ['br', 'gzip']) == 'br'
+        assert negotiate_encoding('gzip;q=1.0, br;q=0.8', ['br', 'gzip']) == 'gzip'
+        assert negotiate_encoding('gzip;q=0', ['gzip']) is None
+
+    def test_wildcard(self):
+        assert negotiate_encoding('*', ['br', 'gzip']) == 'br'
+        assert negotiate_encoding('*;q=0.5, br;q=0', ['br', 'gzip']) == 'gzip'
+
+class TestCompressedBodyCache(object):
+
+    def test_evicts_least_recently_used(self):
+        cache = CompressedBodyCache(10)
+        cache.put('a', 'xxxx')
+        cache.put('b', 'yyyy')
+        cache.get('a')
+        cache.put('c', 'zzzz')
+
+        assert cache.get('b') is None
+        assert cache.get('a') == 'xxxx'
+        assert cache.get('c') == 'zzzz'
+        assert cache.size == 8, cache.size
+
+    def test_compressor_reuses_cached_body(self):
+        compressor = Compressor(cache_size=1024 * 1024)
+        body = 'a' * 4096
+        first = compressor.compress('gzip', body)
+        assert compressor.compress('gzip', body) is first
+        assert gunzip(first) == body
+
+class TestAnnotatorStoreCompression(object):
+
+    def __init__(self, *args, **kwargs):
+        self.store = store.AnnotatorStore(compress_min_size=512)
+        self.sess  = model.Session()
+        self.app   = paste.fixture.TestApp(self.store)
+
+    def setup(self):
+        for x in xrange(20):
+            self.sess.add(Annotation(uri=u'http://xyz.com', text=u'blah text %d' % x))
+        self.sess.commit()
+
+    def teardown(self):
+        self.sess.query(Annotation).delete()
+        self.sess.commit()
+        self.sess.close()
+
+    def test_gzip_response(self):
+        resp = self.app.get('/annotations', headers={'Accept-Encoding': 'gzip'})
+        headers = dict(resp.headers)
+
+        assert headers.get('Content-Encoding') == 'gzip', headers
+        assert headers.get('Vary') == 'Accept-Encoding', headers
+        assert len(json.loads(gunzip(resp.body))) == 20
+
+    def test_identity_response(self):
+        resp = self.app.get('/annotations')
+        headers = dict(resp.headers)
+
+        assert 'Content-Encoding' not in headers, headers
+        assert len(json.loads(resp.body)) == 20
+
+    def test_off_by_default(self):
+        app = paste.fixture.TestApp(store.AnnotatorStore())
+        resp = app.get('/annotations', headers={'Accept-Encoding': 'gzip'})
+
+        assert 'Content-Encoding' not in dict(resp.headers)
+        assert len(json.loads(resp.body)) == 20
+
+    def test_small_response_not_compressed(self):
+        anno = self.sess.query(Annotation).first()
+        resp = self.app.get('/annotations/%s' % anno.id, headers={'Accept-Encoding': 'gzip'})
+
+        assert 'Content-Encoding' not in dict(resp.headers)
+        assert json.loads(resp.body)['id'] == anno.id
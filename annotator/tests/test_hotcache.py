@@ -0,0 +1,172 @@
+import json
+
+import paste.fixture
+
+import annotator.model as model
+from annotator.model import Annotation
+from annotator.hotcache import HotDocumentCache
+import annotator.store as store
+
+class TestHotDocumentCache(object):
+
+    def setup(self):
+        self.annos = [
+            Annotation(id=u'%d' % x, uri=u'http://xyz.com/%d' % (x % 3), text=u'note %d' % x)
+            for x in range(9)
+        ]
+
+    def annos_on(self, uri):
+        return [ x for x in self.annos if x.uri == uri ]
+
+    def test_put_get_find(self):
+        cache = HotDocumentCache(1024 * 1024)
+        uri = u'http://xyz.com/1'
+        doc = cache.put(uri, self.annos_on(uri), cache.generation)
+
+        assert cache.get(uri) is doc
+        assert [ x.id for x in doc.annotations ] == [u'1', u'4', u'7']
+        assert json.loads(cache.find(u'4').json) == self.annos[4].as_dict()
+        assert cache.find(u'5') is None
+        assert cache.size == doc.size
+
+    def test_evicts_least_recently_used(self):
+        uris = [ u'http://xyz.com/%d' % x for x in range(3) ]
+        sizes = [ HotDocumentCache(1024 * 1024).put(x, self.annos_on(x), 0).size for x in uris ]
+        cache = HotDocumentCache(sizes[0] + sizes[1] + sizes[2] - 1)
+
+        for uri in uris:
+            cache.put(uri, self.annos_on(uri), cache.generation)
+        assert cache.get(uris[0]) is None
+        assert cache.find(u'0') is None
+        assert cache.get(uris[1]) is not None
+        assert cache.get(uris[2]) is not None
+        assert cache.size <= cache.max_bytes
+
+    def test_stale_put_ignored(self):
+        cache = HotDocumentCache(1024 * 1024)
+        uri = u'http://xyz.com/1'
+        generation = cache.generation
+        cache.invalidate(uri)
+        cache.put(uri, self.annos_on(uri), generation)
+        assert cache.get(uri) is None
+
+    def test_too_big_not_cached(self):
+        uri = u'http://xyz.com/1'
+        size = HotDocumentCache(1024 * 1024).put(uri, self.annos_on(uri), 0).size
+        cache = HotDocumentCache(size / 2)
+
+        annos = iter(self.annos_on(uri))
+        assert cache.put(uri, annos, cache.generation) is None
+        assert list(annos), 'Read the whole document.'
+        assert cache.get(uri) is None
+        assert cache.size == 0
+        assert cache.too_big(uri)
+        assert not cache.too_big(u'http://xyz.com/2')
+
+    def test_too_big_counts_whole_document(self):
+        # The records fit, but not with the tuple holding them
+        uri = u'http://xyz.com/1'
+        doc = HotDocumentCache(1024 * 1024).put(uri, self.annos_on(uri), 0)
+        cache = HotDocumentCache(sum(x.size() for x in doc.annotations))
+
+        assert cache.put(uri, self.annos_on(uri), cache.generation) is None
+        assert cache.get(uri) is None
+        assert cache.too_big(uri)
+
+    def test_invalidate_clears_too_big(self):
+        uri = u'http://xyz.com/1'
+        cache = HotDocumentCache(1)
+        cache.put(uri, self.annos_on(uri), cache.generation)
+        assert cache.too_big(uri)
+
+        cache.invalidate(uri)
+        assert not cache.too_big(uri)
+
+    def test_too_big_bounded(self):
+        cache = HotDocumentCache(1, max_too_big=2)
+        for x in range(3):
+            cache.put(u'http://xyz.com/%d' % x, self.annos_on(u'http://xyz.com/%d' % x), 0)
+        assert not cache.too_big(u'http://xyz.com/0')
+        assert cache.too_big(u'http://xyz.com/1')
+        assert cache.too_big(u'http://xyz.com/2')
+
+class TestAnnotatorStoreHotCache(object):
+
+    uri = u'http://xyz.com'
+
+    def __init__(self, *args, **kwargs):
+        self.store = store.AnnotatorStore(hot_cache_size=1024 * 1024)
+        self.sess  = model.Session()
+        self.app   = paste.fixture.TestApp(self.store)
+
+    def setup(self):
+        for x in range(5):
+            self.sess.add(Annotation(uri=self.uri, text=u'note %d' % x))
+        self.sess.add(Annotation(uri=u'http://abc.com', text=u'elsewhere'))
+        self.sess.commit()
+
+    def teardown(self):
+        self.sess.query(Annotation).delete()
+        self.sess.commit()
+        self.sess.close()
+
+    def search(self, **kwargs):
+        kwargs.setdefault('uri', self.uri)
+        res = self.app.get('/annotations/search', kwargs)
+        return json.loads(res.body)
+
+    def test_search_matches_database(self):
+        uncached = store.AnnotatorStore()
+        for params in [ {'all_fields': 1}, {}, {'limit': 2, 'offset': 1, 'all_fields': 1}, {'limit': -1} ]:
+            params['uri'] = self.uri
+            exp = json.loads(paste.fixture.TestApp(uncached).get('/annotations/search', params).body)
+            out = self.search(**params)
+            assert out == exp, (params, out, exp)
+
+    def test_search_served_from_cache(self):
+        self.search()
+        assert self.store.hot_cache.get(self.uri) is not None
+
+        # Changes made behind the store's back are not seen...
+        self.sess.add(Annotation(uri=self.uri, text=u'sneaky'))
+        self.sess.commit()
+        assert self.search()['total'] == 5
+
+        # ...but those made through it are.
+        self.app.post('/annotations', {'json': json.dumps({'uri': self.uri})})
+        assert self.search()['total'] == 7
+
+    def test_show_from_cache(self):
+        out = self.search(all_fields=1)['results'][0]
+        res = self.app.get('/annotations/%s' % out['id'], {'callback': 'cb'})
+        assert res.body == 'cb(%s);' % self.store.hot_cache.find(out['id']).json
+
+    def test_update_and_delete_invalidate(self):
+        ids = [ x['id'] for x in self.search()['results'] ]
+
+        self.app.put('/annotations/%s' % ids[0], {'json': json.dumps({'uri': u'http://abc.com'})})
+        assert self.store.hot_cache.get(self.uri) is None
+        assert self.search()['total'] == 4
+        assert self.search(uri=u'http://abc.com')['total'] == 2
+
+        self.app.delete('/annotations/%s' % ids[1])
+        assert self.search()['total'] == 3
+        self.app.get('/annotations/%s' % ids[1], status=404)
+
+    def test_document_bigger_than_cache(self):
+        big = u'http://big.com'
+        for x in range(50):
+            self.sess.add(Annotation(uri=big, text=u'note %d' % x))
+        self.sess.commit()
+
+        app = store.AnnotatorStore(hot_cache_size=2048)
+        uncached = store.AnnotatorStore()
+        for params in [ {'limit': 5}, {'limit': 5, 'offset': 10, 'all_fields': 1}, {'limit': -1} ]:
+            params['uri'] = big
+            exp = json.loads(paste.fixture.TestApp(uncached).get('/annotations/search', params).body)
+            out = json.loads(paste.fixture.TestApp(app).get('/annotations/search', params).body)
+            assert out == exp, (params, out, exp)
+            assert exp['total'] == 50
+
+        assert app.hot_cache.get(big) is None
+        assert app.hot_cache.too_big(big)
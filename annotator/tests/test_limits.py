@@ -0,0 +1,170 @@
+import json
+import threading
+
+import paste.fixture
+
+import annotator.model as model
+from annotator.model import Annotation
+from annotator.limits import RateLimiter, ConcurrencyLimiter
+import annotator.store as store
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestRateLimiter(object):
+
+    def setup(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(2, burst=3, max_clients=2, clock=self.clock)
+
+    def test_burst_then_refill(self):
+        for x in range(3):
+            assert self.limiter.acquire('a') == 0
+        assert self.limiter.acquire('a') == 0.5
+
+        self.clock.now += 0.5
+        assert self.limiter.acquire('a') == 0
+        assert self.limiter.acquire('a') > 0
+
+        self.clock.now += 100
+        for x in range(3):
+            assert self.limiter.acquire('a') == 0
+        assert self.limiter.acquire('a') > 0
+
+    def test_clients_independent(self):
+        for x in range(3):
+            self.limiter.acquire('a')
+        assert self.limiter.acquire('a') > 0
+        assert self.limiter.acquire('b') == 0
+
+    def test_bounded(self):
+        for client in [ 'a', 'b', 'c', 'd' ]:
+            self.limiter.acquire(client)
+        assert len(self.limiter._buckets) == 2
+
+class TestConcurrencyLimiter(object):
+
+    def test_acquire_release(self):
+        limiter = ConcurrencyLimiter(2)
+        assert limiter.acquire()
+        assert limiter.acquire()
+        assert not limiter.acquire()
+        limiter.release()
+        assert limiter.acquire()
+
+class TestAnnotatorStoreLimits(object):
+
+    def __init__(self, *args, **kwargs):
+        self.sess = model.Session()
+
+    def setup(self):
+        for x in range(5):
+            self.sess.add(Annotation(uri=u'http://xyz.com', text=u'note %d' % x))
+        self.sess.commit()
+
+    def teardown(self):
+        self.sess.query(Annotation).delete()
+        self.sess.commit()
+        self.sess.close()
+
+    def test_rate_limit(self):
+        app = paste.fixture.TestApp(store.AnnotatorStore(rate_limit=0.01, rate_burst=2))
+        ip1 = {'REMOTE_ADDR': '10.0.0.1'}
+        ip2 = {'REMOTE_ADDR': '10.0.0.2'}
+
+        app.get('/annotations', extra_environ=ip1)
+        app.get('/annotations', extra_environ=ip1)
+        resp = app.get('/annotations', extra_environ=ip1, status=429)
+        headers = dict(resp.headers)
+        assert int(headers['Retry-After']) > 0, headers
+        assert headers['Access-Control-Allow-Origin'] == '*', headers
+
+        app.get('/annotations', extra_environ=ip2)
+
+    def test_rate_limit_by_user(self):
+        app = paste.fixture.TestApp(store.AnnotatorStore(rate_limit=0.01, rate_burst=1, rate_limit_key='user'))
+        ip = {'REMOTE_ADDR': '10.0.0.1'}
+
+        app.get('/annotations', extra_environ=dict(ip, REMOTE_USER='anna'))
+        app.get('/annotations', extra_environ=dict(ip, REMOTE_USER='levin'))
+        app.get('/annotations', extra_environ=dict(ip, REMOTE_USER='anna'), status=429)
+
+    def test_max_results(self):
+        app = paste.fixture.TestApp(store.AnnotatorStore(max_results=3))
+
+        body = json.loads(app.get('/annotations/search', {'limit': -1}).body)
+        assert body['total'] == 5, body
+        assert len(body['results']) == 3, body
+
+        body = json.loads(app.get('/annotations/search', {'limit': 2}).body)
+        assert len(body['results']) == 2, body
+
+        assert len(json.loads(app.get('/annotations').body)) == 3
+
+        ids = [ x.id for x in self.sess.query(Annotation) ]
+        app.get('/annotations', {'ids': ','.join(ids[:3])})
+        app.get('/annotations', {'ids': ','.join(ids)}, status=400)
+
+    def test_max_concurrent(self):
+        s = store.AnnotatorStore(max_concurrent=1)
+        app = paste.fixture.TestApp(s)
+
+        # Simulate another search in progress
+        assert s.concurrency_limiter.acquire()
+        resp = app.get('/annotations/search', status=429)
+        assert dict(resp.headers)['Retry-After'] == '1'
+        app.post('/annotations', {'json': json.dumps({'uri': u'http://xyz.com'})}, status=429)
+
+        # Cheap requests are still served
+        anno = self.sess.query(Annotation).first()
+        app.get('/annotations/%s' % anno.id)
+
+        s.concurrency_limiter.release()
+        app.get('/annotations/search')
+        app.get('/annotations/search')
+
+    def test_max_concurrent_keeps_rate_tokens(self):
+        s = store.AnnotatorStore(max_concurrent=1, rate_limit=0.01, rate_burst=1)
+        app = paste.fixture.TestApp(s)
+
+        assert s.concurrency_limiter.acquire()
+        app.get('/annotations/search', status=429)
+        s.concurrency_limiter.release()
+
+        # The refused request did not use up the client's only token
+        app.get('/annotations/search')
+        app.get('/annotations/search', status=429)
+        # and a rate limited request does not hold on to the slot
+        assert s.concurrency_limiter.acquire()
+
+    def test_concurrent_requests(self):
+        entered = threading.Event()
+        proceed = threading.Event()
+
+        class SlowStore(store.AnnotatorStore):
+            def search(self):
+                entered.set()
+                proceed.wait(5)
+                return self.request.params['text']
+
+        app = paste.fixture.TestApp(SlowStore(max_concurrent=1))
+        out = []
+        def slow_search():
+            out.append(app.get('/annotations/search', {'text': 'first'}).body)
+        thread = threading.Thread(target=slow_search)
+        thread.start()
+        try:
+            assert entered.wait(5)
+            app.get('/annotations/search', {'text': 'second'}, status=429)
+
+            # Requests served meanwhile do not disturb the one in progress
+            anno = self.sess.query(Annotation).first()
+            assert json.loads(app.get('/annotations/%s' % anno.id).body)['id'] == anno.id
+        finally:
+            proceed.set()
+            thread.join(5)
+        assert out == ['first'], out
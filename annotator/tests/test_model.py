@@ -1,4 +1,14 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import create_engine, MetaData, Table, Column
+from sqlalchemy.types import Unicode, UnicodeText, String
+
+import annotator.model as model
 from annotator.model import Annotation
+from annotator.jsontype import JsonType
 
 def assertProp(obj, name, val):
     if type(obj).__name__ == 'dict':
@@ -45,3 +55,132 @@ class TestAnnotation(object):
         assertProp(anno, 'text', 'Hello')
         assertProp(anno, 'ranges', [r])
 
+
+    def test_merge_dict_timestamps(self):
+        created = datetime(2010, 11, 10, 12, 30)
+        self.anno.merge_dict({'created': u'2001-01-01 00:00:00', 'updated': u'garbage'})
+        assert self.anno.created is None
+        assert self.anno.updated is None
+        assert 'created' not in self.anno.extras
+
+        self.anno.merge_dict({'created': created})
+        assertProp(self.anno, 'created', created)
+
+class TestParseDatetime(object):
+
+    def test_formats(self):
+        for val, exp in [
+                ('2010-11-10', datetime(2010, 11, 10)),
+                ('2010-11-10 12:30', datetime(2010, 11, 10, 12, 30)),
+                ('2010-11-10T12:30:15', datetime(2010, 11, 10, 12, 30, 15)),
+                ('2010-11-10 12:30:15.123456', datetime(2010, 11, 10, 12, 30, 15, 123456)),
+                ('2010-11-10T12:30:15.5', datetime(2010, 11, 10, 12, 30, 15, 500000)),
+            ]:
+            assert model.parse_datetime(val) == exp, val
+
+    def test_invalid(self):
+        for val in [ '', 'yesterday', '2010-11', '2010-11-10 12', '2010-13-01' ]:
+            try:
+                model.parse_datetime(val)
+            except ValueError:
+                pass
+            else:
+                assert False, 'Parsed %r' % val
+
+class TestSession(object):
+
+    def teardown(self):
+        model.Session.remove()
+        model.Session.configure(expire_on_commit=True)
+
+    def test_configure(self):
+        model.Session.remove()
+        model.Session.configure(expire_on_commit=False)
+        sess = model.Session()
+        assert not sess.expire_on_commit
+        assert sess.bind is model.metadata.bind
+
+class TestUpgrade(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' % os.path.join(self.tmpdir, 'old.sqlite3'))
+
+        # The annotation table as created by version 0.4
+        meta = MetaData()
+        self.old = Table('annotation', meta,
+            Column('id', Unicode(36), primary_key=True),
+            Column('uri', UnicodeText),
+            Column('ranges', JsonType),
+            Column('text', UnicodeText),
+            Column('quote', UnicodeText),
+            Column('created', String(26)),
+            Column('user', UnicodeText),
+            Column('tags', JsonType),
+            Column('extras', JsonType),
+        )
+        meta.create_all(bind=self.engine)
+
+    def teardown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_upgrade_engine(self):
+        for row in [
+                {'id': u'a', 'ranges': [{'start': 'p'}], 'extras': {u'x': 1},
+                 'created': '2010-11-10 12:30:15.123456'},
+                {'id': u'b', 'created': '2010-11-10 12:30:15'},
+                {'id': u'c', 'created': None},
+                {'id': u'd', 'created': '2010-11-10T12:30:15Z', 'extras': {u'x': 1}},
+                {'id': u'e', 'created': 'last tuesday'},
+            ]:
+            self.engine.execute(self.old.insert(), row)
+
+        model.upgrade_engine(self.engine, batch_size=2)
+        # Upgrading twice does nothing
+        model.upgrade_engine(self.engine)
+
+        table = model.make_annotation_table(MetaData())
+        rows = dict((x.id, x) for x in self.engine.execute(table.select()))
+
+        assert rows['a'].created == datetime(2010, 11, 10, 12, 30, 15, 123456), rows['a']
+        assert rows['a'].updated == rows['a'].created
+        assert rows['a'].ranges == [{'start': 'p'}], rows['a']
+        assert rows['a'].extras == {u'x': 1}, rows['a']
+        assert rows['b'].created == datetime(2010, 11, 10, 12, 30, 15), rows['b']
+        assert rows['c'].created is None
+        assert rows['d'].created is None and rows['d'].updated is None, rows['d']
+        assert rows['d'].extras == {u'x': 1, u'created': u'2010-11-10T12:30:15Z'}, rows['d']
+        assert rows['e'].extras == {u'created': u'last tuesday'}, rows['e']
+
+        indexes = [ x[1] for x in self.engine.execute("PRAGMA index_list('annotation')") ]
+        assert 'annotation_created_idx' in indexes, indexes
+        assert 'annotation_uri_created_idx' in indexes, indexes
+
+class TestIndexes(object):
+
+    def explain(self, sql):
+        plan = model.metadata.bind.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+        return ' '.join(x[len(x) - 1] for x in plan)
+
+    def test_sorted_search_uses_index(self):
+        for sql in [
+                'SELECT id FROM annotation ORDER BY created, id',
+                "SELECT id FROM annotation WHERE uri = 'x' ORDER BY created, id",
+                "SELECT id FROM annotation WHERE created > '2010-01-01' ORDER BY created, id",
+            ]:
+            plan = self.explain(sql)
+            assert 'INDEX' in plan and 'TEMP B-TREE' not in plan, (sql, plan)
+
+    def test_mysql_uri_index_has_prefix_length(self):
+        statements = []
+        def executor(sql, *args, **kwargs):
+            statements.append(str(sql.compile(dialect=engine.dialect)).strip())
+        engine = create_engine('mysql://', strategy='mock', executor=executor)
+
+        model.make_annotation_table(MetaData()).create(bind=engine, checkfirst=False)
+
+        indexes = [ x for x in statements if x.startswith('CREATE INDEX') ]
+        assert 'CREATE INDEX annotation_uri_created_idx ON annotation (uri(191), created, id)' \
+            in indexes, indexes
+        assert len(indexes) == 3, indexes
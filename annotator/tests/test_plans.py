@@ -0,0 +1,51 @@
+import operator
+
+from sqlalchemy import MetaData
+
+import annotator.model as model
+from annotator.plans import SearchPlanCache
+
+class TestSearchPlanCache(object):
+
+    def setup(self):
+        self.table = model.make_annotation_table(MetaData())
+        self.cache = SearchPlanCache(max_plans=2)
+
+    def test_same_shape_same_plan(self):
+        plan = self.cache.get(self.table, ['uri', 'user'], [])
+        assert self.cache.get(self.table, ['user', 'uri'], []) is plan
+        assert self.cache.get(self.table, ['uri'], []) is not plan
+
+    def test_compiled_once_per_dialect(self):
+        dialect = model.metadata.bind.dialect
+        plan = self.cache.get(self.table, ['uri'], [('created_after', 'created', operator.gt)])
+        count, page, params = plan.compiled(dialect, 10, 5)
+        assert params == {'page_limit': 5, 'page_offset': 10}, params
+
+        # Other pages reuse the same statements
+        again = plan.compiled(dialect, 20, None)
+        assert again[0] is count and again[1] is page
+        assert again[2] == {'page_limit': -1, 'page_offset': 20}, again[2]
+
+        sql = str(page)
+        assert 'annotation.uri = ?' in sql, sql
+        assert 'annotation.created > ?' in sql, sql
+        assert 'ORDER BY annotation.created, annotation.id' in sql, sql
+        assert sql.endswith('LIMIT ? OFFSET ?'), sql
+        assert str(count).startswith('SELECT count(*)'), str(count)
+
+    def test_other_dialects_page_literally(self):
+        from sqlalchemy.dialects.mssql import dialect
+        plan = self.cache.get(self.table, ['uri'], [])
+        count, page, params = plan.compiled(dialect(), 10, 5)
+        assert params == {}, params
+        assert 'mssql_rn>10 AND mssql_rn<=15' in str(page), str(page)
+
+    def test_bounded(self):
+        first = self.cache.get(self.table, ['uri'], [])
+        self.cache.get(self.table, ['user'], [])
+        self.cache.get(self.table, ['uri'], [])
+        self.cache.get(self.table, ['text'], [])
+
+        assert self.cache.get(self.table, ['uri'], []) is first
+        assert len(self.cache._plans) == 2
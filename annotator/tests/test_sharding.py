@@ -0,0 +1,182 @@
+import os
+import json
+import logging
+import shutil
+import tempfile
+
+import paste.fixture
+from sqlalchemy import select
+from sqlalchemy.orm import mapper, clear_mappers
+
+import annotator.model as model
+from annotator.model import Annotation
+import annotator.store as store
+
+class TestShardedStore(object):
+
+    nshards = 3
+
+    def setup(self):
+        self.saved = (model.metadata, model.Session.session_factory)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.dburis = [
+            'sqlite:///%s' % os.path.join(self.tmpdir, 'shard%d.sqlite3' % x)
+            for x in range(self.nshards)
+        ]
+        model.configure_shards(self.dburis)
+        model.createdb()
+
+        self.store = store.AnnotatorStore()
+        self.app   = paste.fixture.TestApp(self.store)
+
+    def teardown(self):
+        model.cleandb()
+        model.shard_pool.close()
+
+        # Put back the in-memory database the other tests use
+        model.metadata, factory = self.saved
+        model.set_session_factory(factory)
+        model.shards = model.shard_pool = None
+        clear_mappers()
+        mapper(Annotation, model.metadata.tables['annotation'])
+
+        shutil.rmtree(self.tmpdir)
+
+    def create(self, **kwargs):
+        resp = self.app.post('/annotations', {'json': json.dumps(kwargs)})
+        resp = self.app.get(dict(resp.headers)['Location'])
+        return json.loads(resp.body)
+
+    def shard_rows(self, shard_id):
+        table = model.metadata.tables['annotation']
+        engine = model.shards[shard_id]
+        return engine.execute(select([table.c.id, table.c.uri])).fetchall()
+
+    def test_annotations_stored_in_uri_shard(self):
+        for x in range(12):
+            self.create(uri=u'http://example.com/%d' % x, text=u'note %d' % x)
+
+        used = set()
+        for shard_id in model.shard_ids():
+            for id, uri in self.shard_rows(shard_id):
+                assert model.shard_for_uri(uri) == shard_id, (uri, shard_id)
+                used.add(shard_id)
+
+        assert len(used) > 1, 'All annotations were stored in one shard.'
+
+    def test_search_by_uri(self):
+        for x in range(6):
+            self.create(uri=u'http://example.com/%d' % (x % 2), text=u'note %d' % x)
+
+        uri = u'http://example.com/1'
+        q = model.Session().query(Annotation).filter_by(uri=uri)
+        assert model.query_shards(q) == [model.shard_for_uri(uri)]
+
+        res = self.app.get('/annotations/search', {'uri': uri, 'all_fields': 1})
+        body = json.loads(res.body)
+        assert body['total'] == 3, body
+        assert set(x['uri'] for x in body['results']) == set([uri])
+
+    def test_search_all_shards_ordered_and_paged(self):
+        created = [
+            self.create(uri=u'http://example.com/%d' % x, text=u'note %d' % x)
+            for x in range(10)
+        ]
+        expected = [ x['id'] for x in sorted(created, key=lambda x: (x['created'], x['id'])) ]
+
+        res = self.app.get('/annotations/search', {'limit': -1})
+        body = json.loads(res.body)
+        assert body['total'] == 10, body
+        assert [ x['id'] for x in body['results'] ] == expected
+
+        paged = []
+        for offset in range(0, 10, 3):
+            res = self.app.get('/annotations/search', {'limit': 3, 'offset': offset})
+            body = json.loads(res.body)
+            assert body['total'] == 10, body
+            paged.extend(x['id'] for x in body['results'])
+        assert paged == expected, paged
+
+        res = self.app.get('/annotations')
+        assert [ x['id'] for x in json.loads(res.body) ] == expected
+
+    def other_shard_uri(self, uri):
+        "A uri which hashes to a different shard than uri."
+        for x in range(100):
+            new_uri = u'http://example.com/b%d' % x
+            if model.shard_for_uri(new_uri) != model.shard_for_uri(uri):
+                return new_uri
+
+    def test_show_update_delete(self):
+        anno = self.create(uri=u'http://example.com/a', text=u'first')
+
+        old_shard = model.shard_for_uri(anno['uri'])
+        new_uri = self.other_shard_uri(anno['uri'])
+
+        url = '/annotations/%s' % anno['id']
+        resp = self.app.put(url, {'json': json.dumps({'uri': new_uri, 'text': u'moved'})})
+        body = json.loads(resp.body)
+        assert body['uri'] == new_uri, body
+        assert body['created'] == anno['created'], body
+        assert body['updated'] >= anno['updated'], body
+
+        assert self.shard_rows(old_shard) == []
+        assert [ x.id for x in self.shard_rows(model.shard_for_uri(new_uri)) ] == [anno['id']]
+
+        body = json.loads(self.app.get(url).body)
+        assert body['text'] == u'moved', body
+
+        resp = self.app.delete(url)
+        assert resp.status == 204
+        resp = self.app.get(url, expect_errors=True)
+        assert resp.status == 404
+
+    def test_failed_move_keeps_original(self):
+        anno = self.create(uri=u'http://example.com/a', text=u'first')
+        old_shard = model.shard_for_uri(anno['uri'])
+        new_uri = self.other_shard_uri(anno['uri'])
+
+        # Make inserts into the target shard fail
+        model.shards[model.shard_for_uri(new_uri)].execute(
+            "CREATE TRIGGER fail_insert BEFORE INSERT ON annotation "
+            "BEGIN SELECT RAISE(ABORT, 'shard unavailable'); END"
+        )
+
+        url = '/annotations/%s' % anno['id']
+        resp = self.app.put(url, {'json': json.dumps({'uri': new_uri, 'text': u'moved'})},
+                            expect_errors=True)
+        assert resp.status == 500, resp.status
+
+        assert [ tuple(x) for x in self.shard_rows(old_shard) ] == [(anno['id'], anno['uri'])]
+        body = json.loads(self.app.get(url).body)
+        assert body['uri'] == anno['uri'], body
+        assert body['text'] == u'first', body
+
+    def test_failed_delete_after_move_logged(self):
+        anno = self.create(uri=u'http://example.com/a', text=u'first')
+        old_shard = model.shard_for_uri(anno['uri'])
+        new_uri = self.other_shard_uri(anno['uri'])
+
+        # Make deletes from the original shard fail
+        model.shards[old_shard].execute(
+            "CREATE TRIGGER fail_delete BEFORE DELETE ON annotation "
+            "BEGIN SELECT RAISE(ABORT, 'shard unavailable'); END"
+        )
+
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger('annotator').addHandler(handler)
+        try:
+            url = '/annotations/%s' % anno['id']
+            resp = self.app.put(url, {'json': json.dumps({'uri': new_uri, 'text': u'moved'})},
+                                expect_errors=True)
+        finally:
+            logging.getLogger('annotator').removeHandler(handler)
+
+        assert resp.status == 500, resp.status
+        assert [ x.id for x in self.shard_rows(old_shard) ] == [anno['id']]
+        assert [ x.id for x in self.shard_rows(model.shard_for_uri(new_uri)) ] == [anno['id']]
+        messages = [ x.getMessage() for x in records ]
+        assert any(anno['id'] in x and 'both' in x for x in messages), messages
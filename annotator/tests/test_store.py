@@ -1,6 +1,7 @@
 import annotator.model as model
 from annotator.model import Annotation
 import annotator.store as store
+from annotator.dispatch import Dispatcher
 
 import json
 
@@ -14,6 +15,7 @@ class TestRoutes(object):
         ('GET',    '%s/1',      'show'),
 
         ('GET',    '%s/search', 'search'), # Custom addition for search
+        ('POST',   '%s/fetch',  'fetch'),  # Custom addition for multi-get
     ]
 
     def __init__(self, *args, **kwargs):
@@ -38,6 +40,56 @@ class TestRoutes(object):
             assert out['action'] == action, \
                 "Action '%s' for '%s %s' was not '%s'." % (out['action'], method, url, action)
 
+    def test_dispatcher_matches_mapper(self):
+        dispatcher = Dispatcher(self.mount_point, self.resource_name,
+                                store.AnnotatorStore.collection)
+        base = self.mount_point + '/' + self.resource_name[1]
+
+        requests = [ (method, url % base) for method, url, action in self.resource_routes ]
+        requests += [
+            ('OPTIONS', base),
+            ('OPTIONS', base + '/1.json'),
+            ('GET',     base + '.json'),
+            ('GET',     base + '/1.json'),
+            ('GET',     base + '/search.json'),
+            ('GET',     base + '/fetch'),
+            ('PUT',     base + '/search'),
+            ('PUT',     base),
+            ('POST',    base + '/1'),
+            ('GET',     base + '/'),
+            ('GET',     base + '/1/2'),
+            ('GET',     '/elsewhere'),
+
+            # Empty ids, formats and action names
+            ('GET',     base + '.'),
+            ('POST',    base + '.'),
+            ('GET',     base + '/.'),
+            ('GET',     base + '/.json'),
+            ('PUT',     base + '/.json'),
+            ('DELETE',  base + '/1.'),
+            ('GET',     base + '/.json.'),
+            ('GET',     base + '/search.'),
+            ('PUT',     base + '/search.'),
+            ('POST',    base + '/fetch.'),
+            ('GET',     base + '/search..json'),
+            ('GET',     base + '/search.a.b'),
+            ('GET',     base + '/1.a.b'),
+        ]
+
+        for method, url in requests:
+            self.store.mapper.environ = { 'REQUEST_METHOD' : method }
+            exp = self.store.mapper.match(url)
+            out = dispatcher.match(method, url)
+
+            assert out == exp, \
+                "Dispatcher gave %s for '%s %s', mapper gave %s." % (out, method, url, exp)
+
+    def test_dispatcher_member_url(self):
+        dispatcher = Dispatcher(self.mount_point, self.resource_name,
+                                store.AnnotatorStore.collection)
+        url = dispatcher.member_url({'SCRIPT_NAME': '/app'}, u'a b')
+        assert url == '/app/.annotation-xyz/foobars/a%20b', url
+
 class TestAnnotatorStore(object):
 
     def __init__(self, *args, **kwargs):
@@ -215,6 +267,104 @@ class TestAnnotatorStore(object):
         body = json.loads(res.body)
         assert len(body['results']) == 3, body
 
+    def test_fetch(self):
+        anno = self.create_test_annotation()
+        anno2 = self.create_test_annotation()
+        ids = [ anno2['id'], 'nonexistent', anno['id'] ]
+
+        url = self.url('annotations', ids=','.join(ids))
+        res = self.app.get(url)
+        body = json.loads(res.body)
+        assert [ x['id'] for x in body ] == ids, body
+        assert body[0] == anno2, body
+        assert body[1] == {'id': 'nonexistent', 'missing': True}, body
+        assert body[2] == anno, body
+
+        url = self.url('fetch_annotations')
+        res = self.app.post(url, {'json': json.dumps({'ids': ids})})
+        assert json.loads(res.body) == body
+
+        res = self.app.post(url, {'json': json.dumps(ids)})
+        assert json.loads(res.body) == body
+
+    def test_fetch_chunked(self):
+        self.store.fetch_chunk_size = 2
+        try:
+            annos = [ self.create_test_annotation() for x in range(5) ]
+            url = self.url('fetch_annotations')
+            res = self.app.post(url, {'ids': ','.join(x['id'] for x in annos)})
+            assert json.loads(res.body) == annos
+        finally:
+            del self.store.fetch_chunk_size
+
+    def test_search_params(self):
+        anno = self.create_test_annotation()
+
+        url = self.url('search_annotations', uri=anno['uri'], callback='jsonp1234', _='1290000000')
+        resp = self.app.get(url)
+        assert resp.body.startswith('jsonp1234('), resp.body
+
+        for params in [ {'extras': u'x'}, {'nonsense': u'x'}, {'created': anno['created']}, {'limit': 'many'} ]:
+            url = self.url('search_annotations', **params)
+            resp = self.app.get(url, expect_errors=True)
+            assert resp.status == 400, params
+
+        url = self.url('search_annotations', uri=anno['uri'], limit=5)
+        self.app.get(url)
+        plans = len(self.store.plans._plans)
+        url = self.url('search_annotations', uri=u'http://other.com', limit=5)
+        assert json.loads(self.app.get(url).body)['total'] == 0
+        assert len(self.store.plans._plans) == plans, "Search with the same shape built a new plan."
+
+    def test_search_paging(self):
+        uri = u'http://paged.com'
+        annos = [ Annotation(uri=uri, text=u'note %d' % x) for x in range(7) ]
+        self.sess.add_all(annos)
+        self.sess.commit()
+
+        res = self.app.get(self.url('search_annotations', uri=uri, limit=-1))
+        expected = [ x['id'] for x in json.loads(res.body)['results'] ]
+        assert len(expected) == 7, expected
+
+        plans = len(self.store.plans._plans)
+        paged = []
+        for offset in range(0, 7, 2):
+            res = self.app.get(self.url('search_annotations', uri=uri, limit=2, offset=offset))
+            paged.extend(x['id'] for x in json.loads(res.body)['results'])
+        assert paged == expected, paged
+        assert len(self.store.plans._plans) == plans, "Paging built a plan per page."
+
+    def test_search_time_range(self):
+        from datetime import datetime
+        annos = [
+            Annotation(uri=u'http://xyz.com', created=datetime(2010, 1, x), updated=datetime(2010, 1, x))
+            for x in range(1, 6)
+        ]
+        self.sess.add_all(annos)
+        self.sess.commit()
+        ids = [ x.id for x in annos ]
+
+        def search(**kwargs):
+            res = self.app.get(self.url('search_annotations', **kwargs))
+            return [ x['id'] for x in json.loads(res.body)['results'] ]
+
+        assert search() == ids
+        assert search(created_after='2010-01-03') == ids[3:]
+        assert search(created_before='2010-01-03') == ids[:2]
+        assert search(created_after='2010-01-01T12:00', created_before='2010-01-04') == ids[1:3]
+        assert search(uri=u'http://xyz.com', created_after='2010-01-04') == ids[4:]
+
+        rsrc = self.url('annotation', id=ids[1])
+        resp = self.app.put(rsrc, {'json': json.dumps({'text': u'changed', 'updated': u'2000-01-01'})})
+        updated = json.loads(resp.body)['updated']
+        assert updated > u'2010-01-06', updated
+
+        assert search(updated_since='2010-01-05') == [ ids[1], ids[4] ]
+
+        url = self.url('search_annotations', created_after='last tuesday')
+        resp = self.app.get(url, expect_errors=True)
+        assert resp.status == 400, "Response code was not 400 Bad Request."
+
     def test_annotate_jsonp(self):
         anno = self.create_test_annotation()
 
@@ -248,3 +398,11 @@ class TestAnnotatorStore(object):
 
         assert headers['Access-Control-Expose-Headers'] == 'Location', \
                 "Did not send the right Access-Control-Expose-Headers header."
+
+class TestAnnotatorStoreFastDispatch(TestAnnotatorStore):
+
+    def __init__(self, *args, **kwargs):
+        import paste.fixture
+        super(TestAnnotatorStoreFastDispatch, self).__init__(*args, **kwargs)
+        self.store = store.AnnotatorStore(fast_dispatch=True)
+        self.app   = paste.fixture.TestApp(self.store)
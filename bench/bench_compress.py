@@ -0,0 +1,69 @@
+"""Benchmark: bytes on the wire and CPU per request with and without
+response compression.
+
+Each configuration gets one warm-up request (which also fills the
+compressed body cache), then the best of 3 runs of n requests is reported.
+
+Usage: python bench/bench_compress.py [annotations] [iterations]
+"""
+import sys
+import timeit
+import urllib
+
+import annotator.model as model
+model.configure('sqlite:///:memory:')
+model.createdb()
+
+from annotator.model import Annotation
+from annotator.store import AnnotatorStore
+from annotator.compress import ENCODERS
+from benchutil import request
+
+def run(app, path, query, accept_encoding, n):
+    fn = lambda: request(app, 'GET', path, query, accept_encoding)
+    size = len(fn())
+    best = min(timeit.repeat(fn, number=n, repeat=3))
+    return size, best / n
+
+def main(count, n):
+    sess = model.Session()
+    for x in xrange(count):
+        sess.add(Annotation(
+            uri=u'http://example.com/doc/%d' % (x % 10),
+            text=u'Annotation number %d about a fairly ordinary passage' % x,
+            quote=u'the quoted passage of the document',
+            ranges=[{'start': '/p[%d]' % x, 'end': '/p[%d]' % x, 'startOffset': 0, 'endOffset': 42}],
+            user=u'user%d' % (x % 7),
+        ))
+    sess.commit()
+    sess.close()
+
+    apps = [
+        ('uncompressed', AnnotatorStore(compress_min_size=None), None),
+    ]
+    for coding in ENCODERS:
+        apps.append((coding, AnnotatorStore(compress_min_size=1024), coding))
+        apps.append((coding + ' (cached)', AnnotatorStore(compress_min_size=1024,
+                                                          compress_cache_size=8 * 1024 * 1024), coding))
+
+    requests = [
+        ('index', '/annotations', ''),
+        ('search', '/annotations/search', urllib.urlencode({'all_fields': 1, 'limit': -1})),
+    ]
+
+    for rname, path, query in requests:
+        for name, app, coding in apps:
+            size, cpu = run(app, path, query, coding, n)
+            print '%-7s %-14s %9d bytes %9.1f us/request' % (rname, name, size, cpu * 1e6)
+
+        # Whole requests vary by more than the cost of compressing, so time
+        # the encoders on their own too.
+        body = request(apps[0][1], 'GET', path, query)
+        for coding, encode in ENCODERS.items():
+            best = min(timeit.repeat(lambda: encode(body), number=n, repeat=3))
+            print '%-7s %-14s %9d bytes %9.1f us/body' % (rname, coding + ' only', len(body), best / n * 1e6)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    main(count, n)
@@ -0,0 +1,54 @@
+"""Microbenchmark: routes.Mapper vs the precompiled Dispatcher.
+
+Times route matching on its own and a full `show` request through the
+store with each dispatcher.
+
+Usage: python bench/bench_dispatch.py [iterations]
+"""
+import sys
+import timeit
+
+import annotator.model as model
+model.configure('sqlite:///:memory:')
+model.createdb()
+
+from annotator.model import Annotation
+from annotator.store import AnnotatorStore
+from annotator.dispatch import Dispatcher
+from benchutil import request
+
+def main(n):
+    sess = model.Session()
+    anno = Annotation(uri=u'http://example.com', text=u'bench')
+    sess.add(anno)
+    sess.commit()
+    path = '/annotations/' + anno.id
+    sess.close()
+
+    store = AnnotatorStore()
+    dispatcher = Dispatcher(collection=AnnotatorStore.collection)
+
+    def mapper_match():
+        store.mapper.environ = {'REQUEST_METHOD': 'GET'}
+        store.mapper.match(path)
+
+    def dispatcher_match():
+        dispatcher.match('GET', path)
+
+    slow = AnnotatorStore()
+    fast = AnnotatorStore(fast_dispatch=True)
+
+    def show(app):
+        return lambda: request(app, 'GET', path)
+
+    for name, fn in [
+            ('match: routes.Mapper', mapper_match),
+            ('match: Dispatcher', dispatcher_match),
+            ('show: routes.Mapper', show(slow)),
+            ('show: Dispatcher', show(fast)),
+        ]:
+        best = min(timeit.repeat(fn, number=n, repeat=3))
+        print '%-24s %8.2f us/call' % (name, best / n * 1e6)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,93 @@
+"""Benchmark: memory per annotation and search time, ORM vs hot cache.
+
+Memory is measured by walking objects with sys.getsizeof, skipping state
+shared between all annotations (the table, mapper, class manager, session).
+
+Usage: python bench/bench_hotcache.py [annotations] [iterations]
+"""
+import sys
+import time
+import types
+import weakref
+
+import annotator.model as model
+model.configure('sqlite:///:memory:')
+model.createdb()
+
+from sqlalchemy.schema import SchemaItem
+from sqlalchemy.orm.mapper import Mapper
+from sqlalchemy.orm.session import Session
+from sqlalchemy.orm.attributes import ClassManager
+
+from annotator.model import Annotation
+from annotator.store import AnnotatorStore
+from annotator.hotcache import CachedDocument, CachedAnnotation
+from benchutil import request
+
+SHARED = (SchemaItem, Mapper, Session, ClassManager, weakref.ref, type,
+          types.FunctionType, types.MethodType, types.ModuleType)
+
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, SHARED):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for x in obj:
+            size += deep_size(x, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, slot):
+            size += deep_size(getattr(obj, slot), seen)
+    return size
+
+def main(count, n):
+    uri = u'http://example.com/hot'
+    sess = model.Session()
+    for x in xrange(count):
+        sess.add(Annotation(
+            uri=uri,
+            text=u'Annotation number %d about a fairly ordinary passage' % x,
+            quote=u'the quoted passage of the document',
+            ranges=[{'start': '/p[%d]' % x, 'end': '/p[%d]' % x, 'startOffset': 0, 'endOffset': 42}],
+            user=u'user%d' % (x % 7),
+            tags=[u'tag%d' % (x % 5)],
+        ))
+    sess.commit()
+    sess.close()
+
+    sess = model.Session()
+    annos = sess.query(Annotation).filter_by(uri=uri).all()
+    orm = deep_size(annos) - sys.getsizeof(annos)
+    orm_dicts = orm + deep_size([ x.as_dict() for x in annos ])
+    doc = CachedDocument(uri, [ CachedAnnotation.from_annotation(x) for x in annos ])
+    compact = deep_size(doc.annotations) - sys.getsizeof(doc.annotations)
+    sess.close()
+
+    print 'Memory per annotation (%d annotations)' % count
+    print '  %-30s %6d bytes' % ('ORM objects', orm / count)
+    print '  %-30s %6d bytes' % ('ORM objects + as_dict()', orm_dicts / count)
+    print '  %-30s %6d bytes' % ('CachedAnnotation', compact / count)
+    print '  %-30s %6d bytes' % ('CachedAnnotation (estimated)', doc.size / count)
+
+    query = 'uri=%s&all_fields=1&limit=-1' % uri
+    for name, app in [
+            ('ORM', AnnotatorStore(compress_min_size=None)),
+            ('hot cache', AnnotatorStore(compress_min_size=None, hot_cache_size=64 * 1024 * 1024)),
+        ]:
+        start = time.time()
+        for x in xrange(n):
+            request(app, path='/annotations/search', query=query)
+        print 'search all_fields: %-10s %9.1f us/request' % (name, (time.time() - start) / n * 1e6)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(count, n)
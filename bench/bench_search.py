@@ -0,0 +1,60 @@
+"""Benchmark: statement compile overhead for searches.
+
+Compares building and compiling an ORM query for each search (as the store
+used to) with looking up cached SearchPlans, then times whole search
+requests.
+
+Usage: python bench/bench_search.py [iterations]
+"""
+import sys
+import timeit
+
+import annotator.model as model
+model.configure('sqlite:///:memory:')
+model.createdb()
+
+from annotator.model import Annotation
+from annotator.store import AnnotatorStore
+from annotator.plans import SearchPlanCache
+from benchutil import request
+
+def main(n):
+    sess = model.Session()
+    for x in xrange(20):
+        sess.add(Annotation(uri=u'http://example.com/%d' % (x % 2), user=u'user%d' % (x % 3)))
+    sess.commit()
+
+    dialect = model.metadata.bind.dialect
+    table = model.metadata.tables['annotation']
+    plans = SearchPlanCache()
+
+    shapes = [
+        ('uri', {'uri': u'http://example.com/1'}),
+        ('uri+user', {'uri': u'http://example.com/1', 'user': u'user1'}),
+    ]
+
+    for name, fields in shapes:
+        def orm():
+            q = sess.query(Annotation).filter_by(**fields)
+            q.statement.compile(dialect=dialect)
+            q.from_self().statement.compile(dialect=dialect)
+            q.order_by(Annotation.created, Annotation.id).limit(100).statement.compile(dialect=dialect)
+
+        def cached():
+            plans.get(table, fields, []).compiled(dialect, 0, 100)
+
+        for label, fn in [ ('ORM compile', orm), ('plan cache', cached) ]:
+            best = min(timeit.repeat(fn, number=n, repeat=3))
+            print '%-9s %-12s %8.1f us/search' % (name, label, best / n * 1e6)
+
+    app = AnnotatorStore(compress_min_size=None)
+    for name, query in [
+            ('uri', 'uri=http://example.com/1'),
+            ('uri+user', 'uri=http://example.com/1&user=user1'),
+        ]:
+        fn = lambda: request(app, path='/annotations/search', query=query)
+        best = min(timeit.repeat(fn, number=n, repeat=3))
+        print '%-9s %-12s %8.1f us/request' % (name, 'search', best / n * 1e6)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
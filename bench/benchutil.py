@@ -0,0 +1,25 @@
+"""Helpers shared by the benchmark scripts."""
+
+def make_environ(method='GET', path='/annotations', query='', accept_encoding=None):
+    "A minimal WSGI environ for a request to the store."
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'SCRIPT_NAME': '',
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': None,
+    }
+    if accept_encoding:
+        environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+    return environ
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+def request(app, method='GET', path='/annotations', query='', accept_encoding=None):
+    "Make a request to app and return the response body."
+    environ = make_environ(method, path, query, accept_encoding)
+    return ''.join(app(environ, start_response))